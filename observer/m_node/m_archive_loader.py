@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+"""
+Sensorlab archive loader module.
+
+`license`	:	MPL
+
+# Overview
+-----------
+This module holds the machinery shared by the node profile and experiment behavior loaders.
+
+An archive is identified by the SHA-256 digest of its content. On first use, it is extracted in a temporary
+directory in a single streaming pass, its manifest is parsed straight from the archive and validated against
+the mandatory members of the loader. Parsed manifests and their temporary directories are cached, so that loading
+the same archive again skips both the extraction and the parsing. Temporary directories are reference counted and
+recycled once released. Archives of persistent loaders are extracted in the observer persistence directory rather
+than in the shared temporary directory, so that they can be reused across restarts.
+
+"""
+import os
+import re
+import stat
+import atexit
+import tempfile
+import tarfile
+import hashlib
+import collections
+import copy
+import concurrent.futures
+import queue
+import json
+import yaml
+import shutil
+
+from ..m_common import m_common
+
+try:
+    # LibYAML bindings
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    # compiled JSON schema validators
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# parsed manifests cache
+MANIFEST_CACHE_SIZE = 32
+# archive hashing chunk size
+HASH_CHUNK_SIZE = 1 << 20
+# archive read buffer size
+ARCHIVE_BUFFER_SIZE = 1 << 20
+# archive files are written by a thread pool, at most this many bytes of file data are buffered in memory
+EXTRACTION_MAX_BUFFERED_SIZE = 256 << 20
+EXTRACTION_WORKERS = min(8, os.cpu_count() or 1)
+# tarfile extraction filters, Python 3.12 and security releases of earlier versions
+_EXTRACTION_FILTER = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+# (loader class, digest) -> (manifest, temporary directory)
+_MANIFEST_CACHE = collections.OrderedDict()
+# temporary directory -> reference count
+_TEMP_DIRECTORY_REFERENCES = {}
+# emptied temporary directories, ready for reuse
+TEMP_DIRECTORY_POOL_SIZE = 4
+_TEMP_DIRECTORY_POOL = queue.Queue(TEMP_DIRECTORY_POOL_SIZE)
+
+# placeholder of missing manifest members, null members being valid
+_MISSING = object()
+
+# parsed manifests and extracted archives persisted across observer restarts
+MANIFEST_CACHE_DIR = os.path.join(m_common.PERSISTENCE_DIR, 'manifests')
+DIGEST_PATTERN = re.compile('[0-9a-f]{64}')
+# persisted temporary directory -> digest of its archive
+_PERSISTED_DIRECTORIES = {}
+# entries left by previous observer runs are pruned on the first lookup
+_persisted_manifests_pruned = False
+
+
+def manifest_schema(paths):
+    """Build the nested dict of mandatory manifest members from their 'a/b/c' paths."""
+    schema = {}
+    for path in paths:
+        node = schema
+        for element in path.split('/'):
+            node = node.setdefault(element, {})
+    return schema
+
+
+def _json_schema(schema):
+    """Translate a tree of mandatory manifest members into a JSON schema."""
+    return {
+        'type': 'object',
+        'required': list(schema),
+        'properties': {element: _json_schema(members) for element, members in schema.items() if members}
+    }
+
+
+def manifest_validator(schema):
+    """Compile a validator of the tree of mandatory manifest members, None if fastjsonschema is unavailable."""
+    return fastjsonschema.compile(_json_schema(schema)) if fastjsonschema else None
+
+
+def _missing_manifest_member(manifest, schema, prefix=''):
+    """Walk the manifest along the schema, return the path of the first missing member or None.
+
+    Members set to null, e.g. an empty `configuration_files` list, are present.
+    """
+    for element, members in schema.items():
+        value = manifest.get(element, _MISSING) if isinstance(manifest, dict) else _MISSING
+        if value is _MISSING:
+            return prefix + element
+        if members:
+            missing = _missing_manifest_member(value, members, prefix + element + '/')
+            if missing:
+                return missing
+    return None
+
+
+def _archive_digest(archive):
+    """Return the SHA-256 hex digest of the archive content."""
+    digest = hashlib.sha256()
+    try:
+        # file upload
+        stream = archive.file
+        offset = stream.tell()
+    except AttributeError:
+        # file on m_system
+        with open(archive, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        stream.seek(offset)
+    return digest.hexdigest()
+
+
+def _new_temp_directory(persistent=False):
+    if persistent:
+        try:
+            os.makedirs(MANIFEST_CACHE_DIR, mode=0o700, exist_ok=True)
+            return tempfile.mkdtemp(dir=MANIFEST_CACHE_DIR)
+        except OSError:
+            # persistence directory unavailable, the archive is not persisted
+            pass
+    try:
+        return _TEMP_DIRECTORY_POOL.get_nowait()
+    except queue.Empty:
+        return tempfile.mkdtemp()
+
+
+def _acquire_temp_directory(temp_directory):
+    _TEMP_DIRECTORY_REFERENCES[temp_directory] = _TEMP_DIRECTORY_REFERENCES.get(temp_directory, 0) + 1
+
+
+def _release_temp_directory(temp_directory):
+    _TEMP_DIRECTORY_REFERENCES[temp_directory] -= 1
+    if _TEMP_DIRECTORY_REFERENCES[temp_directory] == 0:
+        del _TEMP_DIRECTORY_REFERENCES[temp_directory]
+        # the persisted manifest of the archive, if any, refers to this directory
+        digest = _PERSISTED_DIRECTORIES.pop(temp_directory, None)
+        if digest:
+            _remove_persisted_manifest(digest)
+        shutil.rmtree(temp_directory)
+        if not _is_persistence_directory(temp_directory) and not _TEMP_DIRECTORY_POOL.full():
+            # recycle the directory, empty and with mkdtemp() permissions
+            os.mkdir(temp_directory, 0o700)
+            _TEMP_DIRECTORY_POOL.put_nowait(temp_directory)
+
+
+def _cache_manifest(key, manifest, temp_directory):
+    # the cache holds its own reference on the temporary directory
+    _acquire_temp_directory(temp_directory)
+    _MANIFEST_CACHE[key] = (copy.deepcopy(manifest), temp_directory)
+    if len(_MANIFEST_CACHE) > MANIFEST_CACHE_SIZE:
+        _, (_, evicted_directory) = _MANIFEST_CACHE.popitem(last=False)
+        _release_temp_directory(evicted_directory)
+
+
+def _is_persistence_directory(temp_directory):
+    return os.path.dirname(temp_directory) == MANIFEST_CACHE_DIR
+
+
+def _manifest_cache_path(digest):
+    return os.path.join(MANIFEST_CACHE_DIR, digest + '.json')
+
+
+def _remove_persisted_manifest(digest):
+    if not DIGEST_PATTERN.fullmatch(digest):
+        return
+    try:
+        os.remove(_manifest_cache_path(digest))
+    except OSError:
+        pass
+
+
+@atexit.register
+def _release_cached_manifests():
+    """Remove the temporary directories of cached archives on exit.
+
+    Only the most recently loaded persisted archive of each loader class, which the next run starts with, is kept.
+    """
+    kept_classes = set()
+    for key, (_, temp_directory) in reversed(list(_MANIFEST_CACHE.items())):
+        loader_class, _ = key
+        if temp_directory in _PERSISTED_DIRECTORIES and loader_class not in kept_classes:
+            kept_classes.add(loader_class)
+            continue
+        del _MANIFEST_CACHE[key]
+        try:
+            _release_temp_directory(temp_directory)
+        except OSError:
+            pass
+        # still referenced by a loader, its directory is pruned by the next run
+        if temp_directory in _PERSISTED_DIRECTORIES:
+            _remove_persisted_manifest(_PERSISTED_DIRECTORIES.pop(temp_directory))
+    # pooled directories are empty
+    while True:
+        try:
+            os.rmdir(_TEMP_DIRECTORY_POOL.get_nowait())
+        except queue.Empty:
+            break
+        except OSError:
+            pass
+
+
+def _prune_persisted_manifests():
+    """Remove the persisted manifests and directories that are not in use, e.g. left by previous runs."""
+    in_use = {os.path.basename(_manifest_cache_path(digest)) for digest in _PERSISTED_DIRECTORIES.values()}
+    for temp_directory in _TEMP_DIRECTORY_REFERENCES:
+        if _is_persistence_directory(temp_directory):
+            in_use.add(os.path.basename(temp_directory))
+    try:
+        entries = list(os.scandir(MANIFEST_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name in in_use:
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _persist_manifest(digest, manifest, temp_directory):
+    """Persist the parsed manifest and its temporary directory, best effort."""
+    if not _is_persistence_directory(temp_directory):
+        # archive extracted in the shared temporary directory
+        return
+    cache_path = _manifest_cache_path(digest)
+    try:
+        cache_fd = os.open(cache_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(cache_fd, 'w') as cache_file:
+            json.dump({'temp_directory': temp_directory, 'manifest': manifest}, cache_file)
+        os.replace(cache_path + '.tmp', cache_path)
+    except (OSError, TypeError, ValueError):
+        # e.g. YAML values without JSON counterpart, drop the partially written file
+        try:
+            os.remove(cache_path + '.tmp')
+        except OSError:
+            pass
+    else:
+        _PERSISTED_DIRECTORIES[temp_directory] = digest
+
+
+def _filter_member(member, path):
+    """Return the member as the 'data' extraction filter lets it be extracted, raise tarfile.TarError if unsafe.
+
+    Members and link targets must resolve inside path, special files are rejected and special mode bits dropped.
+    """
+    if _EXTRACTION_FILTER:
+        return tarfile.data_filter(member, path)
+    # without extraction filters, check that the parent directory and the link target resolve inside path
+    real_directory = os.path.realpath(path)
+    targets = [os.path.dirname(os.path.join(real_directory, member.name))]
+    if member.issym():
+        targets.append(os.path.join(targets[0], member.linkname))
+    elif member.islnk():
+        targets.append(os.path.join(real_directory, member.linkname))
+    for target in targets:
+        if os.path.commonpath([os.path.realpath(target), real_directory]) != real_directory:
+            raise tarfile.TarError('{0} would be extracted outside of {1}'.format(member.name, path))
+    if not (member.isreg() or member.islnk() or member.isdir() or member.issym()):
+        raise tarfile.TarError('{0} is a special file'.format(member.name))
+    member = copy.copy(member)
+    member.mode &= 0o755
+    return member
+
+
+def _write_member(archive, path, member, data):
+    member_path = os.path.join(path, member.name)
+    os.makedirs(os.path.dirname(member_path), exist_ok=True)
+    with open(member_path, 'wb') as member_file:
+        member_file.write(data)
+    # restore owner (when root), mode and mtime, as tarfile does
+    try:
+        archive.chown(member, member_path, False)
+        archive.chmod(member, member_path)
+        archive.utime(member, member_path)
+    except tarfile.ExtractError:
+        pass
+
+
+def _safe_extract(archive, path, manifest_name):
+    """Extract the archive in a single pass over its members.
+
+    The manifest is parsed straight from the archive and is not written to disk.
+    Regular files are read in memory and written to disk by a thread pool, up to EXTRACTION_MAX_BUFFERED_SIZE
+    bytes pending at once.
+    Return the member names and the parsed manifest (None if missing).
+    """
+    abs_directory = os.path.abspath(path)
+    prefix = os.path.join(abs_directory, '')
+    archive_contents = []
+    manifest = None
+    writes = []
+    buffered_size = 0
+    directories = []
+    executor = concurrent.futures.ThreadPoolExecutor(EXTRACTION_WORKERS)
+    try:
+        for member in archive:
+            abs_target = os.path.abspath(os.path.join(path, member.name))
+            if not (abs_target == abs_directory or abs_target.startswith(prefix)):
+                raise Exception("Attempted Path Traversal in Tar File")
+            try:
+                member = _filter_member(member, abs_directory)
+            except tarfile.TarError as error:
+                raise Exception("Unsafe member in Tar File: {0}".format(error))
+            if abs_target == abs_directory and member.isdir():
+                # the extraction directory keeps its mkdtemp() attributes
+                archive_contents.append(member.name)
+                continue
+            if member.name == manifest_name:
+                manifest = yaml.load(archive.extractfile(member), Loader=SafeLoader)
+            elif member.isreg() and member.size <= EXTRACTION_MAX_BUFFERED_SIZE:
+                if buffered_size + member.size > EXTRACTION_MAX_BUFFERED_SIZE:
+                    # wait for pending writes to release their buffers
+                    for write in writes:
+                        write.result()
+                    writes = []
+                    buffered_size = 0
+                data = archive.extractfile(member).read()
+                writes.append(executor.submit(_write_member, archive, path, member, data))
+                buffered_size += member.size
+            else:
+                if member.islnk():
+                    # the link target may still be pending
+                    for write in writes:
+                        write.result()
+                if member.isdir():
+                    # like extractall(), keep directories writable until their content is extracted
+                    directories.append(member)
+                    if member.mode is not None:
+                        member = copy.copy(member)
+                        member.mode = 0o700
+                archive.extract(member, path, **_EXTRACTION_FILTER)
+            archive_contents.append(member.name)
+        for write in writes:
+            write.result()
+    finally:
+        executor.shutdown()
+    # set directories attributes, deepest first
+    directories.sort(key=lambda directory: directory.name, reverse=True)
+    for directory in directories:
+        directory_path = os.path.join(path, directory.name)
+        try:
+            archive.chown(directory, directory_path, False)
+            archive.utime(directory, directory_path)
+            archive.chmod(directory, directory_path)
+        except tarfile.ExtractError:
+            pass
+    return archive_contents, manifest
+
+
+class ArchiveLoader:
+    """Archive loader base class.
+
+    Subclasses describe the archive layout with the class attributes below and complete the loading
+    in `_post_manifest`, once the manifest is parsed and validated.
+    """
+    # filename of uploaded archives in the temporary directory
+    archive_filename = None
+    # members the archive must contain
+    mandatory_members = []
+    # manifest member of the archive
+    manifest_name = None
+    # tree of mandatory manifest members, see `manifest_schema`, and its compiled validator
+    manifest_schema = {}
+    manifest_validator = None
+    # exception raised on invalid archives
+    exception = m_common.SensorlabException
+    # persist parsed manifests across observer restarts
+    persistent = False
+
+    def __init__(self, archive):
+        global _persisted_manifests_pruned
+        self.temp_directory = None
+        self.manifest = None
+
+        digest = _archive_digest(archive)
+        # archives are cached per loader class, each class validating its own archive layout
+        key = (type(self), digest)
+        if key not in _MANIFEST_CACHE and self.persistent:
+            # archive extracted and parsed by a previous observer run
+            persisted = self._load_persisted_manifest(digest)
+            if persisted:
+                _cache_manifest(key, *persisted)
+        if self.persistent and not _persisted_manifests_pruned:
+            _persisted_manifests_pruned = True
+            _prune_persisted_manifests()
+        cached = key in _MANIFEST_CACHE
+        if cached:
+            # archive already extracted and parsed
+            _MANIFEST_CACHE.move_to_end(key)
+            manifest, self.temp_directory = _MANIFEST_CACHE[key]
+            self.manifest = copy.deepcopy(manifest)
+        else:
+            self.temp_directory = _new_temp_directory(self.persistent)
+        # the loader holds a reference on the temporary directory until clean(), or until loading fails
+        _acquire_temp_directory(self.temp_directory)
+        try:
+            if not cached:
+                self._extract(archive)
+
+            # validate the manifest
+            path = self._find_missing_manifest_member()
+            if path:
+                raise self.exception(m_common.ERROR_MISSING_ARGUMENT_IN_MANIFEST.format(path))
+
+            if not cached:
+                _cache_manifest(key, self.manifest, self.temp_directory)
+                if self.persistent:
+                    _persist_manifest(digest, self.manifest, self.temp_directory)
+
+            self._post_manifest()
+        except BaseException:
+            _release_temp_directory(self.temp_directory)
+            raise
+
+    def _extract(self, archive):
+        """Extract the content of the archive in the temporary directory and parse its manifest."""
+        if hasattr(archive, 'save'):
+            # file upload
+            archive_path = os.path.join(self.temp_directory, self.archive_filename)
+            archive.save(archive_path)
+        else:
+            # file on m_system, open it in place
+            archive_path = archive
+        # stream the archive once, decompressing and extracting as it is read
+        with tarfile.open(archive_path, mode='r|gz', bufsize=ARCHIVE_BUFFER_SIZE) as archive_file:
+            archive_contents, self.manifest = _safe_extract(archive_file, self.temp_directory, self.manifest_name)
+        # validate the archive content
+        contents_set = frozenset(archive_contents)
+        missing_members = [elt for elt in self.mandatory_members if elt not in contents_set]
+        if missing_members:
+            raise self.exception(m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(', '.join(missing_members)))
+
+    def _find_missing_manifest_member(self):
+        """Return the path of the first missing mandatory member of the manifest, None if it is valid."""
+        # compiled validators are plain functions, looked up on the class so as not to be bound to the loader
+        validator = type(self).manifest_validator
+        if validator:
+            try:
+                validator(self.manifest)
+                return None
+            except fastjsonschema.JsonSchemaException:
+                pass
+        # walk the manifest to locate the missing member
+        return _missing_manifest_member(self.manifest, self.manifest_schema)
+
+    def _load_persisted_manifest(self, digest):
+        """Return the persisted (manifest, temporary directory) of the archive, None if missing or stale."""
+        try:
+            cache_file = open(_manifest_cache_path(digest), 'r')
+        except OSError:
+            return None
+        try:
+            with cache_file:
+                cached = json.load(cache_file)
+            manifest = cached['manifest']
+            temp_directory = cached['temp_directory']
+            # the temporary directory must be a private directory of the observer in the persistence directory
+            status = os.lstat(temp_directory)
+            valid = (_is_persistence_directory(temp_directory) and stat.S_ISDIR(status.st_mode) and
+                     status.st_uid == os.getuid() and stat.S_IMODE(status.st_mode) == 0o700)
+            valid = valid and all(os.path.exists(file) for file in self._manifest_files(manifest, temp_directory))
+        except (OSError, ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            # stale entry
+            _remove_persisted_manifest(digest)
+            return None
+        _PERSISTED_DIRECTORIES[temp_directory] = digest
+        return manifest, temp_directory
+
+    def _manifest_files(self, manifest, temp_directory):
+        """Return the paths of the extracted files referenced by the manifest."""
+        return []
+
+    def _post_manifest(self):
+        pass
+
+    def clean(self):
+        _release_temp_directory(self.temp_directory)
@@ -51,12 +51,9 @@ Placeholders are resolved when the manifest is parsed for the first time.
 """
 
 import os
-import tempfile
-import shutil
-import tarfile
-import yaml
 
 from .. import m_common
+from . import m_archive_loader
 
 PROFILE_FILENAME = 'behavior.tar.gz'
 # archive members
@@ -76,87 +73,40 @@ MANIFEST_MANDATORY_MEMBERS = [
     'schedule'
 ]
 
+MANIFEST_SCHEMA = m_archive_loader.manifest_schema(MANIFEST_MANDATORY_MEMBERS)
+
+
+class Loader(m_archive_loader.ArchiveLoader):
+    archive_filename = PROFILE_FILENAME
+    mandatory_members = CONFIGURATION_MANDATORY_MEMBERS
+    manifest_name = EXPERIMENT_MANIFEST
+    manifest_schema = MANIFEST_SCHEMA
+    manifest_validator = m_archive_loader.manifest_validator(MANIFEST_SCHEMA)
+    exception = m_common.ExperimentSetupException
 
-class Loader:
     def __init__(self, behavior_archive):
-        self.temp_directory = None
-        self.manifest = None
         self.firmwares = {}
         self.schedule = None
+        super(Loader, self).__init__(behavior_archive)
 
-        # create a temporary directory and extract the content of the archive
-        self.temp_directory = tempfile.mkdtemp()
-        archive_path = os.path.join(self.temp_directory, PROFILE_FILENAME)
-        try:
-            # file upload
-            behavior_archive.save(archive_path)
-        except AttributeError:
-            # file on m_system
-            shutil.copy(behavior_archive, archive_path)
-
-        with tarfile.open(archive_path) as archive:
-            # validate the archive content
-            archive_contents = archive.getnames()
-            if any(elt not in archive_contents for elt in CONFIGURATION_MANDATORY_MEMBERS):
-                # invalid archive content, raise an exception
-                missing_elements = [elt for elt in CONFIGURATION_MANDATORY_MEMBERS if elt not in archive_contents]
-                raise m_common.ExperimentSetupException(
-                    m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(
-                        'missing elements: ' + str(missing_elements) +
-                        ' of archive_contents: ' + str(archive_contents)
-                    )
-                )
-            # decompress the archive
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(archive, self.temp_directory)
-
-        # read the manifest
-        with open(os.path.join(self.temp_directory, EXPERIMENT_MANIFEST), 'r') as manifest_file:
-            self.manifest = yaml.load(manifest_file.read())
-        # validate the manifest
-        for path in MANIFEST_MANDATORY_MEMBERS:
-            # let's walk the manifest and check that mandatory members do exist
-            iterator = self.manifest
-            path_elements = path.split('/')
-            for element in path_elements:
-                try:
-                    iterator = iterator[element]
-                except:
-                    raise m_common.ExperimentSetupException(
-                        m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(
-                            'element missing: ' + element + ' in: ' + path
-                        )
-                    )
-
+    def _post_manifest(self):
         # register firmwares
         firmwares_dir = os.path.join(self.temp_directory, FIRMWARES_SUBDIR)
+        available_firmwares = None
         for firmware in self.manifest['firmwares']:
+            if available_firmwares is None:
+                # scanned once, on the first listed firmware
+                try:
+                    with os.scandir(firmwares_dir) as entries:
+                        available_firmwares = {entry.name for entry in entries if entry.is_file()}
+                except OSError:
+                    raise m_common.ExperimentSetupException(
+                        m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(FIRMWARES_SUBDIR))
             fid = firmware['id']
             ffile = firmware['file']
             self.firmwares[fid] = os.path.join(firmwares_dir, ffile)
-            # check if node_firmware file is present
-            if not os.path.isfile(self.firmwares[fid]):
+            # check if node_firmware file is present, files in subdirectories are checked individually
+            if ffile not in available_firmwares and not os.path.isfile(self.firmwares[fid]):
                 raise m_common.ExperimentSetupException(m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(ffile))
         # register the schedule
         self.schedule = self.manifest['schedule']
-
-    def clean(self):
-        shutil.rmtree(self.temp_directory)
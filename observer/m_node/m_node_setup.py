@@ -76,12 +76,10 @@ Placeholders are resolved when the manifest is parsed for the first time.
 
 """
 import os
-import tempfile
-import tarfile
-import yaml
-import shutil
+import re
 
 from ..m_common import m_common
+from . import m_archive_loader
 
 # configuration archive filename
 PROFILE_FILENAME = 'node-profile.tar.gz'
@@ -122,87 +120,48 @@ MANIFEST_MANDATORY_MEMBERS = [
     'serial/module'
 ]
 
-
-class Loader:
-    def __init__(self, profile_archive):
-
-        # create a temporary directory and extract the content of the archive
-        self.temp_directory = tempfile.mkdtemp()
-        archive_path = os.path.join(self.temp_directory, PROFILE_FILENAME)
-        try:
-            # file upload
-            profile_archive.save(archive_path)
-        except AttributeError:
-            # file on m_system
-            shutil.copy(profile_archive, archive_path)
-        with tarfile.open(archive_path) as archive:
-            # validate the archive content
-            archive_contents = archive.getnames()
-            if any(elt not in archive_contents for elt in PROFILE_MANDATORY_MEMBERS):
-                # invalid archive content, raise an exception
-                missing_arguments = filter(lambda argument: argument not in archive_contents, PROFILE_MANDATORY_MEMBERS)
-                raise m_common.NodeSetupException(
-                    m_common.ERROR_MISSING_ARGUMENT_IN_ARCHIVE.format(' ,'.join(missing_arguments))
-                )
-
-            # decompress the archive
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(archive, self.temp_directory)
-
-        # read the manifest
-        with open(os.path.join(self.temp_directory, PROFILE_MANIFEST), 'r') as self.manifest_file:
-            self.manifest = yaml.load(self.manifest_file.read())
-
-        # validate the manifest
-        for path in MANIFEST_MANDATORY_MEMBERS:
-            iterator = self.manifest
-            path_elements = path.split('/')
-            for element in path_elements:
-                try:
-                    iterator = iterator[element]
-                except:
-                    raise m_common.NodeSetupException(m_common.ERROR_MISSING_ARGUMENT_IN_MANIFEST.format(element))
-
-        # replace placeholders and complete path names in executables entries
-        if self.manifest['controller']['executables']:
-            for executable in self.manifest['controller']['executables']:
-                eid = executable['id']
-                efile = executable['file']
-                executables_dir = os.path.join(self.temp_directory, CONTROLLER_EXECUTABLES_SUBDIR)
-                for cmd_name, cmd in self.manifest['controller']['commands']:
-                    self.manifest['controller']['commands'][cmd_name] = \
-                        cmd.replace('<!{0}>'.format(eid), os.path.join(executables_dir, efile))
-
-        # replace placeholders and complete path names in configuration file entries
-        if self.manifest['controller']['configuration_files']:
-            for configuration_file in self.manifest['controller']['configuration_files']:
-                cid = configuration_file['id']
-                cfile = configuration_file['file']
-                configuration_files_dir = os.path.join(self.temp_directory, CONTROLLER_CONFIGURATION_FILES_SUBDIR)
-                for cmd_name, cmd in self.manifest['controller']['commands'].items():
-                    self.manifest['controller']['commands'][cmd_name] = \
-                        cmd.replace('<#{0}>'.format(cid), os.path.join(configuration_files_dir, cfile))
+MANIFEST_SCHEMA = m_archive_loader.manifest_schema(MANIFEST_MANDATORY_MEMBERS)
+
+# controller commands placeholders: <!executable_id> and <#configuration_file_id>
+PLACEHOLDER_PATTERN = re.compile(r'<([!#])([^>]+)>')
+
+
+class Loader(m_archive_loader.ArchiveLoader):
+    archive_filename = PROFILE_FILENAME
+    mandatory_members = PROFILE_MANDATORY_MEMBERS
+    manifest_name = PROFILE_MANIFEST
+    manifest_schema = MANIFEST_SCHEMA
+    manifest_validator = m_archive_loader.manifest_validator(MANIFEST_SCHEMA)
+    exception = m_common.NodeSetupException
+    persistent = True
+
+    def _manifest_files(self, manifest, temp_directory):
+        files = [os.path.join(temp_directory, SERIAL_SUBDIR, manifest['serial']['module'])]
+        files += [os.path.join(temp_directory, CONTROLLER_EXECUTABLES_SUBDIR, executable['file'])
+                  for executable in manifest['controller']['executables'] or []]
+        files += [os.path.join(temp_directory, CONTROLLER_CONFIGURATION_FILES_SUBDIR, configuration_file['file'])
+                  for configuration_file in manifest['controller']['configuration_files'] or []]
+        return files
+
+    def _post_manifest(self):
+        # complete path names of executables and configuration files
+        executables_dir = os.path.join(self.temp_directory, CONTROLLER_EXECUTABLES_SUBDIR)
+        configuration_files_dir = os.path.join(self.temp_directory, CONTROLLER_CONFIGURATION_FILES_SUBDIR)
+        controller = self.manifest['controller']
+        placeholders = {
+            '!': {str(executable['id']): os.path.join(executables_dir, executable['file'])
+                  for executable in controller['executables'] or []},
+            '#': {str(configuration_file['id']): os.path.join(configuration_files_dir, configuration_file['file'])
+                  for configuration_file in controller['configuration_files'] or []}
+        }
+
+        # replace placeholders, unknown placeholders (e.g. <#firmware>) are left untouched
+        def replace_placeholder(match):
+            return placeholders[match.group(1)].get(match.group(2), match.group(0))
+
+        commands = controller['commands']
+        for cmd_name, cmd in commands.items():
+            commands[cmd_name] = PLACEHOLDER_PATTERN.sub(replace_placeholder, cmd)
 
         serial_directory = os.path.join(self.temp_directory, SERIAL_SUBDIR)
         self.manifest['serial']['module'] = os.path.join(serial_directory, self.manifest['serial']['module'])
-
-    def clean(self):
-        shutil.rmtree(self.temp_directory)